@@ -1,14 +1,25 @@
 # writingassistant.py
 
 import os
+import json
+import asyncio
+import threading
+import time
+import zipfile
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from io import BytesIO
+import httpx
+import numpy as np
 import streamlit as st
-# from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import PromptTemplate
-from docx import Document
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
+
+# No LangSmith tracer is attached; keep LangChain from serializing runs for one unless a deployment opts in.
+os.environ.setdefault("LANGCHAIN_TRACING_V2", "false")
+
+# First Streamlit call, so the missing-key st.error below still gets the page config.
+st.set_page_config(page_title="AI-Powered Grant Writing Assistant", layout="centered")
 
 
 # =========================
@@ -17,7 +28,12 @@ from reportlab.lib.styles import getSampleStyleSheet
 def _init_once():
     defaults = {
         "proposal_body": "",
+        "proposal_paragraphs": (),
         "proposal_title": "proposal",
+        "proposal_model": "",
+        "proposal_variants": (),
+        "_last_key": None,
+        "_reused_key": None,
         # stored (canonical) values that we’ll keep in sync with inputs on submit
         "project_title": "",
         "project_description": "",
@@ -26,6 +42,10 @@ def _init_once():
         "funder_focus_areas": "",
         "funder_requirements": "",
         "target_audience": "",
+        # batch mode (OpenAI Batch API)
+        "batch_queue": [],
+        "batches": [],  # one {"id", "titles", "zip", "failed"} per submitted batch, newest first
+        "batch_csv_key": 0,  # bumped after a submit so the uploader comes back empty
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -58,72 +78,487 @@ _init_input_keys_once()
 # =========================
 # Credentials
 # =========================
-api_key = None
-try:
-    api_key = st.secrets["OPENAI_API_KEY"]  # Streamlit Cloud (Secrets)
-except Exception:
+@st.cache_resource
+def get_api_key() -> str:
+    """
+    Resolve the OpenAI key once per process instead of re-reading secrets/.env on every rerun.
+    Stops the script (without caching anything) if no key is configured.
+    """
+    try:
+        return st.secrets["OPENAI_API_KEY"]  # Streamlit Cloud (Secrets)
+    except Exception:
+        pass
     # Local .env for dev
+    api_key = None
     try:
         from dotenv import load_dotenv
         load_dotenv()
         api_key = os.getenv("OPENAI_API_KEY")
     except Exception:
         pass
+    if not api_key:
+        st.error("OpenAI API key not found. Add it to Streamlit secrets or your local .env.")
+        st.stop()
+    return api_key
+
 
-if not api_key:
-    st.error("OpenAI API key not found. Add it to Streamlit secrets or your local .env.")
-    st.stop()
+api_key = get_api_key()
 
 
 # =========================
 # Model
 # =========================
-llm = ChatOpenAI(
-    model="gpt-4",
-    temperature=0.3,
-    openai_api_key=api_key,
-)
+# Cheapest/fastest first; gpt-4 stays available for users who want the larger model.
+MODEL_OPTIONS = ["gpt-4o-mini", "gpt-4o", "gpt-4"]
+TEMPERATURE = 0.3
+# 900 words is ~1200 tokens; cap decode just above so a runaway reply can't bill far past the target.
+MAX_TOKENS = 1400
+# The prompt asks the model to close with this marker; sending it as a stop sequence ends decoding
+# right there instead of letting the model pad past the last paragraph.
+END_MARKER = "<<END>>"
+VARIANT_COUNT = 3
+# Identical requests at TEMPERATURE come back as near-copies; the fan-out samples hotter so the
+# variants actually differ.
+VARIANT_TEMPERATURE = 0.85
+
+
+@st.cache_resource
+def _http_client() -> httpx.Client:
+    """
+    Shared keep-alive pool (HTTP/2) for every OpenAI client in the app (chat, embeddings, Batch API),
+    so back-to-back calls reuse one TLS connection instead of each client opening its own.
+    """
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=16),
+        timeout=httpx.Timeout(600.0, connect=5.0),  # same as the OpenAI SDK default
+    )
+
+
+@st.cache_resource
+def _http_async_client() -> httpx.AsyncClient:
+    """
+    Async counterpart of _http_client() for ainvoke (variant fan-out): concurrent requests multiplex
+    over one HTTP/2 connection. Only ever used from the _event_loop() thread.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=16),
+        timeout=httpx.Timeout(600.0, connect=5.0),
+    )
+
+
+@st.cache_resource
+def get_llm(model: str, temperature: float):
+    """
+    Build the chat client once per process; reruns and sessions share it (and its connection pool).
+    langchain_openai is imported here so reruns and first paint don't pay for it.
+    """
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(
+        model=model,
+        temperature=temperature,
+        max_tokens=MAX_TOKENS,
+        stop=[END_MARKER],
+        openai_api_key=api_key,
+        http_client=_http_client(),
+        http_async_client=_http_async_client(),
+    )
+
+
+@st.cache_resource
+def get_openai_client():
+    """
+    Plain OpenAI SDK client for endpoints LangChain doesn't wrap (file uploads, Batch API).
+    """
+    from openai import OpenAI
+
+    return OpenAI(api_key=api_key, http_client=_http_client())
+
+
+def _stream_chunks(model: str, temperature: float, system_prompt: str, user_prompt: str, min_chars: int = 80):
+    """
+    Yield the reply in pieces of at least `min_chars` so the page redraws every few words rather
+    than on every token.
+    """
+    buf = []
+    size = 0
+    for chunk in get_llm(model, temperature).stream([("system", system_prompt), ("user", user_prompt)]):
+        if chunk.content:
+            buf.append(chunk.content)
+            size += len(chunk.content)
+            if size >= min_chars:
+                yield "".join(buf)
+                buf.clear()
+                size = 0
+    if buf:
+        yield "".join(buf)
+
+
+@st.cache_resource
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """
+    One long-lived loop on a daemon thread. The cached client's async HTTP pool stays bound to a
+    single loop, which a fresh asyncio.run() per rerun would break.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop()).result()
+
+
+async def _fan_out(llm, messages: list, n: int) -> list:
+    """
+    Fire `n` identical requests concurrently; wall time is roughly the slowest one, not the sum.
+    """
+    replies = await asyncio.gather(*(llm.ainvoke(messages) for _ in range(n)))
+    return [(r.content or "").strip() for r in replies]
+
+
+# =========================
+# Response cache
+# =========================
+# Exact-match store of finished proposals keyed by (model, temperature, prompt). It lives in a small
+# SQLite file rather than st.cache_data because a streamed reply has to be written after the fact.
+CACHE_DB = os.getenv("PROPOSAL_CACHE_DB", ".proposal_cache.sqlite3")
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+# Optional: with REDIS_URL set (and the `redis` package installed) the store is shared across
+# replicas and restarts instead of living in a per-container SQLite file.
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_PREFIX = "llm_cache:"
+
+
+@st.cache_resource
+def _init_cache_db() -> str:
+    with closing(sqlite3.connect(CACHE_DB)) as conn, conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic ("
+            "embedding_model TEXT NOT NULL, scope TEXT NOT NULL, title TEXT NOT NULL, "
+            "body TEXT NOT NULL, vec BLOB NOT NULL, created REAL NOT NULL)"
+        )
+    return CACHE_DB
+
+
+def _cache_key(model: str, temperature: float, system_prompt: str, user_prompt: str) -> str:
+    raw = "\x1f".join([model, repr(temperature), system_prompt, user_prompt])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@st.cache_resource
+def _redis():
+    if not REDIS_URL:
+        return None
+    try:
+        import redis
+
+        # Short timeouts plus an up-front ping: an unreachable server falls back to SQLite at once
+        # instead of stalling every lookup on the OS connect timeout.
+        client = redis.Redis.from_url(
+            REDIS_URL, decode_responses=True, socket_connect_timeout=0.5, socket_timeout=0.5
+        )
+        client.ping()
+        return client
+    except Exception:
+        return None
+
+
+@st.cache_resource
+def _hot_cache() -> dict:
+    """
+    In-process key -> (body, created) front for the SQLite store; repeat hits are a dict probe.
+    """
+    return {"lock": threading.Lock(), "items": {}}
+
+
+HOT_CACHE_SIZE = 256
+
+
+def _remember(key: str, body: str, created: float) -> None:
+    hot = _hot_cache()
+    with hot["lock"]:
+        items = hot["items"]
+        items[key] = (body, created)
+        while len(items) > HOT_CACHE_SIZE:
+            items.pop(next(iter(items)))
+
+
+def _cache_get(key: str):
+    row = _hot_cache()["items"].get(key)
+    if row is None and _redis() is not None:
+        try:
+            body = _redis().get(REDIS_PREFIX + key)
+        except Exception:
+            body = None
+        if body is not None:
+            _remember(key, body, time.time())
+        return body  # Redis expires entries itself, and puts never reach SQLite while it is up
+    if row is None:
+        try:
+            with closing(sqlite3.connect(_init_cache_db())) as conn:
+                row = conn.execute("SELECT body, created FROM responses WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row:
+            _remember(key, row[0], row[1])
+    if row and time.time() - row[1] < CACHE_TTL_SECONDS:
+        return row[0]
+    return None
+
+
+def _cache_put(key: str, body: str) -> None:
+    created = time.time()
+    _remember(key, body, created)
+    if _redis() is not None:
+        try:
+            _redis().setex(REDIS_PREFIX + key, CACHE_TTL_SECONDS, body)
+            return
+        except Exception:
+            pass  # fall back to the local store
+    try:
+        with closing(sqlite3.connect(_init_cache_db())) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, body, created) VALUES (?, ?, ?)",
+                (key, body, created),
+            )
+    except sqlite3.Error:
+        pass
+
+
+# Near-duplicate submissions (e.g. "Restore wetlands in NY" vs "Restore wetland areas in NY") miss the
+# exact-match store, so finished proposals are also indexed by an embedding of the normalized inputs.
+EMBEDDING_MODEL = "text-embedding-3-small"
+LOCAL_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_THRESHOLD = 0.95
+SEMANTIC_MAX_ROWS = 2048  # in-memory cap; expired, then oldest, rows are dropped past it
+
+
+@st.cache_resource
+def get_embedder():
+    """
+    Return (name, embed_fn). Prefers a local sentence-transformers model when that optional package
+    is installed, so a cache lookup costs no network round-trip; otherwise uses OpenAI embeddings.
+    """
+    try:
+        from sentence_transformers import SentenceTransformer
+
+        local = SentenceTransformer(LOCAL_EMBEDDING_MODEL)
+        return LOCAL_EMBEDDING_MODEL, lambda text: local.encode(text, normalize_embeddings=True)
+    except Exception:
+        pass
+    from langchain_openai import OpenAIEmbeddings
+
+    remote = OpenAIEmbeddings(model=EMBEDDING_MODEL, openai_api_key=api_key, http_client=_http_client())
+    return EMBEDDING_MODEL, remote.embed_query
+
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _embed(text: str) -> np.ndarray:
+    vec = np.asarray(get_embedder()[1](text), dtype=np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+def _canonical_fields(fields: dict) -> str:
+    return "\n".join(f"{k}: {' '.join(v.lower().split())}" for k, v in sorted(fields.items()))
+
+
+def _semantic_scope(model: str) -> str:
+    """
+    Like the exact-match key, a semantic hit is only valid for the model, temperature and system
+    prompt that wrote it; changing any of them retires the old rows.
+    """
+    return _cache_key(model, TEMPERATURE, SYSTEM_PROMPT, "")
+
+
+@st.cache_resource
+def _semantic_index() -> dict:
+    """
+    Process-wide index shared by all sessions, loaded once from the SQLite store so it survives
+    container restarts. Rows 0..n-1 of `matrix` line up with `meta` (scope, title, body, created),
+    so a lookup is a single matrix-vector product; capacity doubles when full.
+    """
+    index = {"lock": threading.Lock(), "meta": [], "matrix": None, "n": 0}
+    scopes = [_semantic_scope(m) for m in MODEL_OPTIONS]
+    cutoff = time.time() - CACHE_TTL_SECONDS
+    try:
+        with closing(sqlite3.connect(_init_cache_db())) as conn, conn:
+            conn.execute("DELETE FROM semantic WHERE created < ?", (cutoff,))
+            rows = conn.execute(
+                "SELECT scope, title, body, created, vec FROM semantic "
+                f"WHERE embedding_model = ? AND scope IN ({', '.join('?' * len(scopes))}) ORDER BY rowid DESC LIMIT ?",
+                (get_embedder()[0], *scopes, SEMANTIC_MAX_ROWS),
+            ).fetchall()[::-1]
+    except sqlite3.Error:
+        rows = []
+    if rows:
+        index["matrix"] = np.stack([np.frombuffer(r[4], dtype=np.float32) for r in rows])
+        index["meta"] = [r[:4] for r in rows]
+        index["n"] = len(rows)
+    return index
+
+
+def _semantic_get(model: str, title: str, vec: np.ndarray):
+    """
+    Return a cached body whose inputs embed within SEMANTIC_THRESHOLD of `vec` and whose
+    project title overlaps this one, or None.
+    """
+    index = _semantic_index()
+    with index["lock"]:
+        n = index["n"]
+        matrix, meta = index["matrix"], index["meta"][:n]
+    if not n:
+        return None
+    scope, cutoff = _semantic_scope(model), time.time() - CACHE_TTL_SECONDS
+    sims = matrix[:n] @ vec
+    sims[np.array([s != scope or created < cutoff for s, _, _, created in meta])] = -1.0
+    best = int(sims.argmax())
+    _, cached_title, body, _ = meta[best]
+    a, b = title.lower(), cached_title.lower()
+    if sims[best] > SEMANTIC_THRESHOLD and a and b and (a in b or b in a):
+        return body
+    return None
+
+
+def _semantic_prune(index: dict, cutoff: float) -> None:
+    """
+    Drop expired rows, then the oldest, to make room for one more. Builds new arrays instead of
+    compacting in place, so a concurrent _semantic_get keeps a consistent snapshot. Caller holds the lock.
+    """
+    n, meta = index["n"], index["meta"]
+    keep = [i for i in range(n) if meta[i][3] >= cutoff][-(SEMANTIC_MAX_ROWS - 1):]
+    index["matrix"] = index["matrix"][keep].copy()
+    index["meta"] = [meta[i] for i in keep]
+    index["n"] = len(keep)
+
+
+def _semantic_put(model: str, title: str, vec: np.ndarray, body: str) -> None:
+    scope, created = _semantic_scope(model), time.time()
+    index = _semantic_index()
+    with index["lock"]:
+        if index["n"] >= SEMANTIC_MAX_ROWS:
+            _semantic_prune(index, created - CACHE_TTL_SECONDS)
+        matrix, n = index["matrix"], index["n"]
+        if matrix is None or n == len(matrix):
+            grown = np.empty((max(2 * n, 16), vec.shape[0]), dtype=np.float32)
+            if n:
+                grown[:n] = matrix[:n]
+            index["matrix"] = matrix = grown
+        matrix[n] = vec
+        index["meta"].append((scope, title, body, created))
+        index["n"] = n + 1
+    try:
+        with closing(sqlite3.connect(_init_cache_db())) as conn, conn:
+            conn.execute(
+                "INSERT INTO semantic (embedding_model, scope, title, body, vec, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (get_embedder()[0], scope, title, body, vec.astype(np.float32).tobytes(), created),
+            )
+    except sqlite3.Error:
+        pass
 
 
 # =========================
 # Prompt
 # =========================
-email_proposal_prompt = PromptTemplate(
-    input_variables=[
-        "project_title",
-        "project_description",
-        "project_objectives",
-        "funder_mission",
-        "funder_focus_areas",
-        "funder_requirements",
-        "target_audience",
-    ],
-    template=(
-        "You are an experienced grant writer. Using ONLY the inputs below, draft a full, email-style grant proposal "
-        "written as 3–6 cohesive paragraphs (no headings, no bullet lists). Do not include a greeting or a sign-off. "
-        "If a detail is missing, write 'TBD' rather than inventing facts. Keep the tone professional, persuasive, and concise. "
-        "Aim for 500–900 words.\n\n"
-        "Inputs:\n"
-        "- Project Title: {project_title}\n"
-        "- Project Description: {project_description}\n"
-        "- Key Objectives: {project_objectives}\n"
-        "- Funder Mission: {funder_mission}\n"
-        "- Funder Focus Areas: {funder_focus_areas}\n"
-        "- Funder Requirements: {funder_requirements}\n"
-        "- Target Audience/Beneficiaries: {target_audience}\n\n"
-        "Output:\n"
-        "A polished, multi-paragraph email-style proposal body (no salutation, no signature)."
-    ),
+# The static instructions go in the system message, kept byte-for-byte identical across calls, and only
+# the short user message varies. This is for structure: OpenAI's automatic prompt caching needs a
+# 1024-token prefix, far more than this prompt, and it is deliberately not padded to reach that.
+SYSTEM_PROMPT = (
+    "You are an experienced grant writer. Using ONLY the inputs provided, draft an email-style grant proposal body "
+    "of 3–6 cohesive paragraphs, 500–900 words: no headings, bullets, greeting or sign-off. "
+    "Write 'TBD' for missing details rather than inventing facts. Tone: professional, persuasive, concise. "
+    f"End with {END_MARKER} on its own line."
+)
+
+PROPOSAL_FIELDS = (
+    "project_title",
+    "project_description",
+    "project_objectives",
+    "funder_mission",
+    "funder_focus_areas",
+    "funder_requirements",
+    "target_audience",
+)
+
+# Plain str.format_map template: the fields are fixed, so LangChain's PromptTemplate validation
+# and bookkeeping on every submit buys nothing.
+USER_TEMPLATE = (
+    "Inputs:\n"
+    "- Project Title: {project_title}\n"
+    "- Project Description: {project_description}\n"
+    "- Key Objectives: {project_objectives}\n"
+    "- Funder Mission: {funder_mission}\n"
+    "- Funder Focus Areas: {funder_focus_areas}\n"
+    "- Funder Requirements: {funder_requirements}\n"
+    "- Target Audience/Beneficiaries: {target_audience}"
 )
 
 
+# =========================
+# Export helpers
+# =========================
+# python-docx and ReportLab are imported inside the builders so cold starts don't pay for them
+# until a proposal actually exists.
+@st.cache_resource
+def _body_style():
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+    # spaceAfter replaces a Spacer flowable between every pair of paragraphs
+    return ParagraphStyle("body", parent=getSampleStyleSheet()["Normal"], spaceAfter=12)
+
+
+def _docx_bytes(paragraphs: tuple) -> bytes:
+    from docx import Document
+
+    buf = BytesIO()
+    doc = Document()
+    for para in paragraphs:
+        doc.add_paragraph(para)
+    doc.save(buf)
+    return buf.getvalue()
+
+
+def _pdf_bytes(paragraphs: tuple, style) -> bytes:
+    from reportlab.platypus import SimpleDocTemplate, Paragraph
+
+    buf = BytesIO()
+    pdf_doc = SimpleDocTemplate(buf)
+    flow = [Paragraph(para, style) for para in paragraphs]
+    pdf_doc.build(flow)
+    return buf.getvalue()
+
+
+@st.cache_resource
+def _export_pool() -> ThreadPoolExecutor:
+    # Cached rather than a bare module global, which every rerun would rebuild along with its threads.
+    return ThreadPoolExecutor(max_workers=2)
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_exports(paragraphs: tuple) -> tuple:
+    """
+    Serialize the proposal to (DOCX, PDF) bytes once per distinct set of paragraphs; reruns reuse
+    the cached pair. The two independent builds run on worker threads side by side.
+    """
+    style = _body_style()
+    docx_job = _export_pool().submit(_docx_bytes, paragraphs)
+    pdf_job = _export_pool().submit(_pdf_bytes, paragraphs, style)
+    return docx_job.result(), pdf_job.result()
+
+
 # =========================
 # UI
 # =========================
-st.set_page_config(page_title="AI-Powered Grant Writing Assistant", layout="centered")
 st.title("AI-Powered Grant Writing Assistant")
 st.caption("Provide the essential details and the assistant will generate a proposal based on your inputs.")
 
+with st.sidebar:
+    st.selectbox("Model", MODEL_OPTIONS, key="model_name")
+
 with st.form("proposal_form"):
     st.text_input(
         "Project Title",
@@ -161,9 +596,21 @@ with st.form("proposal_form"):
         placeholder="Communities in flood-prone watersheds; local conservation partners",
     )
 
-    submitted = st.form_submit_button("Generate Proposal")
+    col_one, col_many, col_queue = st.columns(3)
+    with col_one:
+        submitted = st.form_submit_button("Generate Proposal")
+    with col_many:
+        variants_submitted = st.form_submit_button(f"Generate {VARIANT_COUNT} Variants")
+    with col_queue:
+        queued = st.form_submit_button("Queue for Batch")
+
+
+def _set_proposal(body: str):
+    st.session_state.proposal_body = body
+    st.session_state.proposal_paragraphs = tuple(p for p in body.split("\n\n") if p)
 
-if submitted:
+
+if submitted or variants_submitted or queued:
     # Trim and persist from input keys to stored canonical keys
     def _clean(k: str) -> str:
         return (st.session_state.get(k) or "").strip()
@@ -176,61 +623,237 @@ if submitted:
     st.session_state.funder_requirements = _clean("inp_funder_requirements")
     st.session_state.target_audience = _clean("inp_target_audience")
 
-    try:
-        with st.spinner("Generating proposal..."):
-            prompt = email_proposal_prompt.format(
-                project_title=st.session_state.project_title,
-                project_description=st.session_state.project_description,
-                project_objectives=st.session_state.project_objectives,
-                funder_mission=st.session_state.funder_mission,
-                funder_focus_areas=st.session_state.funder_focus_areas,
-                funder_requirements=st.session_state.funder_requirements,
-                target_audience=st.session_state.target_audience,
-            )
-            resp = llm.invoke(prompt)
-            st.session_state.proposal_body = (resp.content or "").strip()
-            title = st.session_state.project_title or "proposal"
-            st.session_state.proposal_title = "_".join(title.split())
-        st.success("Proposal generated.")
-    except Exception as e:
-        st.error(f"Error generating proposal: {e}")
+    model = st.session_state.model_name
+    fields = {f: st.session_state[f] for f in PROPOSAL_FIELDS}
+    prompt = USER_TEMPLATE.format_map(fields)
+    slug = "_".join((st.session_state.project_title or "proposal").split())
+    last_key = (model, *sorted(fields.items()))
+
+    if queued:
+        # No API call now; the fields go out with the next sidebar batch at Batch API pricing.
+        st.session_state.batch_queue.append(fields)
+        st.success(f"Queued for batch ({len(st.session_state.batch_queue)} waiting).")
+    elif variants_submitted:
+        st.session_state._last_key = None
+        try:
+            with st.spinner(f"Generating {VARIANT_COUNT} variants..."):
+                messages = [("system", SYSTEM_PROMPT), ("user", prompt)]
+                replies = run_async(_fan_out(get_llm(model, VARIANT_TEMPERATURE), messages, VARIANT_COUNT))
+                variants = tuple(v for v in replies if v)
+                st.session_state.proposal_variants = variants
+                _set_proposal(variants[0] if variants else "")
+                st.session_state.proposal_model = model
+                st.session_state.proposal_title = slug
+            st.success("Variants generated.")
+        except Exception as e:
+            st.error(f"Error generating variants: {e}")
+    elif last_key == st.session_state._last_key and st.session_state.proposal_body:
+        # Double-click or "regenerate" with nothing changed: the previous result is still on screen.
+        st.info("Inputs unchanged; showing previous result.")
+    else:
+        try:
+            key = _cache_key(model, TEMPERATURE, SYSTEM_PROMPT, prompt)
+            reused, vec = False, None
+            # The lookups (an embedding call, or the local model's first load) run before any token
+            # appears, so they get the spinner; the stream below is its own progress indicator.
+            with st.spinner("Generating proposal..."):
+                body = _cache_get(key)
+                # A blank title would pass the title-overlap guard for any cached proposal, and a second
+                # submit of inputs that were just answered from a near-duplicate asks for a fresh draft.
+                if body is None and fields["project_title"] and st.session_state._reused_key != last_key:
+                    try:
+                        vec = _embed(_canonical_fields(fields))
+                    except Exception:
+                        vec = None  # the semantic layer is best-effort; never block generation on it
+                    if vec is not None:
+                        body = _semantic_get(model, fields["project_title"], vec)
+                        reused = body is not None
+            if body is None:
+                # Show tokens as they arrive; the finished text is rendered below with the downloads.
+                live = st.empty()
+                body = (live.write_stream(_stream_chunks(model, TEMPERATURE, SYSTEM_PROMPT, prompt)) or "").strip()
+                live.empty()
+                if body:
+                    # Only text written for exactly these inputs goes into the exact-match store.
+                    if vec is not None:
+                        _semantic_put(model, fields["project_title"], vec, body)
+                    _cache_put(key, body)
+            _set_proposal(body)
+            st.session_state.proposal_variants = ()
+            st.session_state.proposal_model = model
+            st.session_state.proposal_title = slug
+            if reused:
+                st.session_state._reused_key = last_key
+                st.session_state._last_key = None
+                st.info("Showing a proposal written for near-identical inputs. Submit again to generate a fresh one.")
+            else:
+                # Only remember the inputs once their proposal is actually on screen; a failed or stopped
+                # run must not make the previous proposal look like the answer to these inputs.
+                st.session_state._reused_key = None
+                if body:
+                    st.session_state._last_key = last_key
+                st.success("Proposal generated.")
+        except Exception as e:
+            st.session_state._last_key = None
+            st.error(f"Error generating proposal: {e}")
 
 # =========================
 # Output + Downloads
 # =========================
-if st.session_state.proposal_body:
+@st.fragment
+def render_outputs():
+    """
+    Runs as a fragment so clicking a download button only reruns this block, not the whole script.
+    """
+    if not st.session_state.proposal_body:
+        return
+
+    if st.session_state.proposal_variants:
+        st.subheader("Variants")
+        tabs = st.tabs([f"Variant {i + 1}" for i in range(len(st.session_state.proposal_variants))])
+        for i, (tab, text) in enumerate(zip(tabs, st.session_state.proposal_variants)):
+            with tab:
+                st.markdown(text)
+                st.button("Use this variant", key=f"use_variant_{i}", on_click=_set_proposal, args=(text,))
+
     st.subheader("Generated Proposal")
+    st.caption(f"Model: {st.session_state.proposal_model}")
     st.markdown(st.session_state.proposal_body)
+    docx_bytes, pdf_bytes = build_exports(st.session_state.proposal_paragraphs)
 
     # DOCX download
-    docx_buffer = BytesIO()
-    doc = Document()
-    for para in st.session_state.proposal_body.split("\n\n"):
-        doc.add_paragraph(para)
-    doc.save(docx_buffer)
-    docx_buffer.seek(0)
     st.download_button(
         "⬇️ Download as DOCX",
-        data=docx_buffer,
+        data=docx_bytes,
         file_name=f"{st.session_state.proposal_title}.docx",
         mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
         key="dl_docx",
     )
 
     # PDF download
-    pdf_buffer = BytesIO()
-    pdf_doc = SimpleDocTemplate(pdf_buffer)
-    styles = getSampleStyleSheet()
-    flow = []
-    for para in st.session_state.proposal_body.split("\n\n"):
-        flow.append(Paragraph(para, styles["Normal"]))
-        flow.append(Spacer(1, 12))
-    pdf_doc.build(flow)
-    pdf_buffer.seek(0)
     st.download_button(
         "⬇️ Download as PDF",
-        data=pdf_buffer,
+        data=pdf_bytes,
         file_name=f"{st.session_state.proposal_title}.pdf",
         mime="application/pdf",
         key="dl_pdf",
     )
+
+
+render_outputs()
+
+
+# =========================
+# Batch mode
+# =========================
+# Bulk generation through the OpenAI Batch API: half the token price, results within 24 h.
+def _batch_requests_jsonl(rows: list, model: str) -> bytes:
+    lines = []
+    for i, row in enumerate(rows):
+        lines.append(json.dumps({
+            "custom_id": f"row-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "temperature": TEMPERATURE,
+                "max_tokens": MAX_TOKENS,
+                "stop": [END_MARKER],
+                "messages": [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": USER_TEMPLATE.format_map(row)},
+                ],
+            },
+        }))
+    return "\n".join(lines).encode("utf-8")
+
+
+def _batch_results_zip(output_text: str, titles: list) -> tuple:
+    """
+    Return (zip_bytes, failed) where `failed` lists "NNN title" for rows the Batch API didn't complete.
+    """
+    buf = BytesIO()
+    failed = []
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for line in output_text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            i = int(result["custom_id"].split("-", 1)[1])
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                failed.append(f"{i + 1:03d} {titles[i] or 'proposal'}")
+                continue
+            body = (response["body"]["choices"][0]["message"]["content"] or "").strip()
+            paragraphs = tuple(p for p in body.split("\n\n") if p)  # same split as _set_proposal
+            name = f"{i + 1:03d}_{'_'.join(titles[i].split()) or 'proposal'}"
+            # Built directly: one-off files, so they shouldn't occupy build_exports' cache.
+            zf.writestr(f"{name}.docx", _docx_bytes(paragraphs))
+            zf.writestr(f"{name}.pdf", _pdf_bytes(paragraphs, _body_style()))
+    return buf.getvalue(), sorted(failed)
+
+
+with st.sidebar:
+    st.header("Batch mode")
+    st.caption(
+        "Queue proposals from the form and/or upload a CSV with one row per proposal. Columns: "
+        + ", ".join(PROPOSAL_FIELDS)
+        + ". Results are ready within 24 hours."
+    )
+    batch_csv = st.file_uploader("Proposals CSV", type="csv", key=f"batch_csv_{st.session_state.batch_csv_key}")
+    if st.session_state.batch_queue:
+        st.write(f"Queued from form: {len(st.session_state.batch_queue)}")
+
+    if (batch_csv is not None or st.session_state.batch_queue) and st.button("Submit batch", key="batch_submit"):
+        try:
+            rows = list(st.session_state.batch_queue)
+            if batch_csv is not None:
+                import pandas as pd
+
+                df = pd.read_csv(batch_csv, dtype=str).fillna("")
+                rows += [{f: str(rec.get(f, "")).strip() for f in PROPOSAL_FIELDS} for rec in df.to_dict("records")]
+            client = get_openai_client()
+            jsonl = _batch_requests_jsonl(rows, st.session_state.model_name)
+            upload = client.files.create(file=("requests.jsonl", jsonl), purpose="batch")
+            batch = client.batches.create(
+                input_file_id=upload.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+            # Earlier batches stay listed (they are already paid for), and the submitted rows leave the
+            # queue and the uploader so a second click can't send them again.
+            st.session_state.batches.insert(0, {"id": batch.id, "titles": [r["project_title"] for r in rows], "zip": b"", "failed": []})
+            st.session_state.batch_queue = []
+            st.session_state.batch_csv_key += 1
+            st.success(f"Submitted {len(rows)} proposals.")
+        except Exception as e:
+            st.error(f"Error submitting batch: {e}")
+
+    for entry in st.session_state.batches:
+        st.write(f"Batch: `{entry['id']}` ({len(entry['titles'])} proposals)")
+        if not entry["zip"] and st.button("Check results", key=f"batch_check_{entry['id']}"):
+            try:
+                client = get_openai_client()
+                batch = client.batches.retrieve(entry["id"])
+                if batch.status == "completed" and batch.output_file_id:
+                    output_text = client.files.content(batch.output_file_id).text
+                    entry["zip"], entry["failed"] = _batch_results_zip(output_text, entry["titles"])
+                elif batch.status in ("failed", "expired", "cancelled"):
+                    st.error(f"Batch {batch.status}.")
+                else:
+                    counts = batch.request_counts
+                    done = f" ({counts.completed}/{counts.total} done)" if counts else ""
+                    st.info(f"Status: {batch.status}{done}.")
+            except Exception as e:
+                st.error(f"Error checking batch: {e}")
+
+        if entry["zip"]:
+            st.download_button(
+                "⬇️ Download all (ZIP)",
+                data=entry["zip"],
+                file_name=f"proposals_{entry['id']}.zip",
+                mime="application/zip",
+                key=f"dl_batch_zip_{entry['id']}",
+            )
+        if entry["failed"]:
+            st.warning("Not generated (left out of the ZIP): " + "; ".join(entry["failed"]))